@@ -1,20 +1,245 @@
+from array import array
+from concurrent.futures import ProcessPoolExecutor
 from itertools import count
+import multiprocessing
 import numpy as np
-import math
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:  # Python < 3.8, ParallelEM needs it
+    shared_memory = None
+
+try:
+    from numba import get_num_threads, njit, prange
+except ImportError:  # numba is optional, the NumPy code path is used without it
+    njit = None
+
+try:
+    import cupy as cp
+    import cupyx.scipy.sparse
+except ImportError:  # cupy is optional, GpuEM needs it
+    cp = None
+
+# assumed per-core L2 size, used to pick the document block size of the NumPy EM step
+L2_CACHE_BYTES = 1 << 20
 
 
 def normalize(input_matrix):
     """
-    Normalizes the rows of a 2d input_matrix so they sum to 1
+    Normalizes the rows of a 2d input_matrix so they sum to 1, in place for
+    floating-point input (other dtypes are normalized into a float64 copy).
+    Rows that sum to zero are left as zeros.
     """
 
+    if not np.issubdtype(input_matrix.dtype, np.inexact):
+        input_matrix = input_matrix.astype(np.float64)
     row_sums = input_matrix.sum(axis=1)
-    try:
-        assert (np.count_nonzero(row_sums)==np.shape(row_sums)[0]) # no row should sum to zero
-    except Exception:
-        raise Exception("Error while normalizing. Row(s) sum to zero")
-    new_matrix = input_matrix / row_sums[:, np.newaxis]
-    return new_matrix
+    nonzero = row_sums != 0
+    np.reciprocal(row_sums, out=row_sums, where=nonzero)
+    input_matrix *= np.where(nonzero, row_sums, 0)[:, np.newaxis]
+    return input_matrix
+
+
+if njit is not None:
+    @njit(parallel=True, fastmath=True, cache=True)
+    def em_sweep(indptr, indices, data, doc_topic, topic_word, doc_topic_new, topic_word_new, number_of_chunks):
+        """
+        One fused EM sweep over a CSR term-doc matrix. Fills doc_topic_new with the
+        unnormalized P(z | d) counts and topic_word_new with the unnormalized P(w | z)
+        counts. Documents are split into number_of_chunks chunks (one per thread), each
+        accumulating into its own copy of topic_word_new that is summed at the end.
+        """
+        number_of_documents, number_of_topics = doc_topic.shape
+        number_of_chunks = min(number_of_chunks, max(number_of_documents, 1))
+        partial = np.zeros((number_of_chunks,) + topic_word_new.shape, dtype=topic_word_new.dtype)
+        for c in prange(number_of_chunks):
+            prob = np.empty(number_of_topics, dtype=doc_topic.dtype)
+            start = c * number_of_documents // number_of_chunks
+            stop = (c + 1) * number_of_documents // number_of_chunks
+            for d in range(start, stop):
+                for k in range(number_of_topics):
+                    doc_topic_new[d, k] = 0.0
+                for j in range(indptr[d], indptr[d + 1]):
+                    w = indices[j]
+                    total = 0.0
+                    for k in range(number_of_topics):
+                        prob[k] = doc_topic[d, k] * topic_word[k, w]
+                        total += prob[k]
+                    # total = 0 means every prob[k] is 0, so the scale is never needed
+                    scale = data[j] / total if total > 0.0 else 0.0
+                    for k in range(number_of_topics):
+                        q = prob[k] * scale
+                        partial[c, k, w] += q
+                        doc_topic_new[d, k] += q
+        topic_word_new[:] = partial.sum(axis=0)
+
+
+def em_counts(indptr, indices, data, doc_topic, topic_word, number_of_threads=None):
+    """
+    Fused E- and M-step for the documents in doc_topic: accumulates the M-step counts
+    directly from P(z | d) and P(w | z), so the D x K x V P(z | d, w) tensor is never
+    materialized. The CSR arrays indptr/indices/data hold the counts of the same
+    documents. Returns the unnormalized (P(z | d), P(w | z)) counts.
+    """
+    number_of_documents, number_of_topics = doc_topic.shape
+    vocabulary_size = topic_word.shape[1]
+    topic_word_new = np.zeros((number_of_topics, vocabulary_size), dtype=np.float32)
+    document_topic_new = np.zeros((number_of_documents, number_of_topics), dtype=np.float32)
+    if njit is not None:
+        em_sweep(indptr, indices, data, doc_topic, topic_word, document_topic_new, topic_word_new,
+                 number_of_threads or get_num_threads())
+    else:
+        # At each nonzero count, q_k = c(w, d) P(z_k | d) P(w | z_k) / P(w | d); the new
+        # P(z | d) counts sum q over the words of a document, the P(w | z) counts over
+        # the documents containing a word. Documents are processed in blocks whose
+        # nnz x K gathers fit in half of L2.
+        topic_word_t = topic_word.T
+        block_nnz = max(1, L2_CACHE_BYTES // 2 // (4 * max(number_of_topics, 1)))
+        start = 0
+        while start < number_of_documents:
+            stop = int(np.searchsorted(indptr, indptr[start] + block_nnz, side='right')) - 1
+            stop = min(max(stop, start + 1), number_of_documents)
+            lo, hi = indptr[start], indptr[stop]
+            if hi > lo:
+                lengths = np.diff(indptr[start:stop + 1])
+                rows = np.repeat(np.arange(stop - start), lengths)
+                cols = indices[lo:hi]
+                prob = doc_topic[start:stop][rows] * topic_word_t[cols]
+                word_prob = prob.sum(axis=1, keepdims=True)
+                # dividing first keeps every factor <= 1, so a subnormal P(w | d) cannot overflow;
+                # where P(w | d) = 0 every prob is 0 as well and is left as is
+                np.divide(prob, word_prob, out=prob, where=word_prob > 0)
+                prob *= data[lo:hi, np.newaxis]
+
+                # rows are contiguous, so per-document sums are a reduceat over the nonempty ones
+                nonempty = lengths > 0
+                document_topic_new[start:stop][nonempty] = np.add.reduceat(
+                    prob, (indptr[start:stop] - lo)[nonempty], axis=0)
+                # same for words after sorting the block by column
+                order = np.argsort(cols, kind='stable')
+                cols = cols[order]
+                first = np.flatnonzero(np.concatenate(([True], cols[1:] != cols[:-1])))
+                topic_word_new[:, cols[first]] += np.add.reduceat(prob[order], first, axis=0).T
+            start = stop
+    return document_topic_new, topic_word_new
+
+
+# arrays shared with the current worker process, see ParallelEM
+_shared_arrays = {}
+
+
+def _attach_shared_arrays(specs):
+    for name, (shm_name, shape, dtype) in specs.items():
+        shm = shared_memory.SharedMemory(name=shm_name)
+        _shared_arrays[name] = (shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf))
+
+
+def _em_counts_chunk(bounds):
+    start, stop = bounds
+    arrays = {name: array for name, (shm, array) in _shared_arrays.items()}
+    indptr = arrays["indptr"][start:stop + 1]
+    lo, hi = indptr[0], indptr[-1]
+    return em_counts(indptr - lo, arrays["indices"][lo:hi], arrays["data"][lo:hi],
+                     arrays["doc_topic"][start:stop], arrays["topic_word"], number_of_threads=1)
+
+
+class ParallelEM(object):
+
+    """
+    Runs em_counts over contiguous chunks of documents in number_of_workers processes.
+    The CSR term-doc counts and the current P(z | d), P(w | z) live in shared memory; each
+    worker returns the P(z | d) counts of its chunk and its own P(w | z) counts, which
+    are summed here.
+    """
+
+    def __init__(self, corpus, number_of_topics, number_of_workers):
+        if shared_memory is None:
+            raise ImportError("ParallelEM requires multiprocessing.shared_memory (Python 3.8+)")
+        number_of_documents = corpus.number_of_documents
+        arrays = {
+            "indptr": corpus.term_doc_indptr,
+            "indices": corpus.term_doc_indices,
+            "data": corpus.term_doc_data,
+            "doc_topic": np.zeros((number_of_documents, number_of_topics), dtype=np.float32),
+            "topic_word": np.zeros((number_of_topics, corpus.vocabulary_size), dtype=np.float32),
+        }
+        self.shared = {}
+        self.arrays = {}
+        self.executor = None
+        try:
+            for name, source in arrays.items():
+                shm = shared_memory.SharedMemory(create=True, size=max(source.nbytes, 1))
+                self.shared[name] = shm
+                self.arrays[name] = np.ndarray(source.shape, dtype=source.dtype, buffer=shm.buf)
+                self.arrays[name][...] = source
+
+            bounds = np.linspace(0, number_of_documents, number_of_workers + 1).astype(np.int64)
+            self.chunks = [(start, stop) for start, stop in zip(bounds[:-1], bounds[1:]) if start < stop]
+            specs = {name: (self.shared[name].name, array.shape, array.dtype.str)
+                     for name, array in self.arrays.items()}
+            # spawn rather than fork: forking after numba's thread pool has started can deadlock
+            self.executor = ProcessPoolExecutor(number_of_workers, mp_context=multiprocessing.get_context("spawn"),
+                                                initializer=_attach_shared_arrays, initargs=(specs,))
+        except BaseException:
+            self.close()
+            raise
+
+    def em_counts(self, doc_topic, topic_word):
+        self.arrays["doc_topic"][...] = doc_topic
+        self.arrays["topic_word"][...] = topic_word
+        results = list(self.executor.map(_em_counts_chunk, self.chunks))
+        topic_word_new = results[0][1] if results else np.zeros_like(self.arrays["topic_word"])
+        for _, topic_word_chunk in results[1:]:
+            topic_word_new += topic_word_chunk
+        document_topic_new = np.concatenate([doc_topic_chunk for doc_topic_chunk, _ in results]) \
+            if results else np.zeros_like(self.arrays["doc_topic"])
+        return document_topic_new, topic_word_new
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+        self.arrays = {}
+        for shm in self.shared.values():
+            shm.close()
+            shm.unlink()
+        self.shared = {}
+
+
+class GpuEM(object):
+
+    """
+    Runs the fused EM step on the GPU with CuPy. The term-doc counts stay on the
+    device as a CSR matrix, so each step only uploads P(z | d), P(w | z) and
+    downloads the new counts; the contractions are cuSPARSE/cuBLAS products.
+    """
+
+    def __init__(self, corpus):
+        if cp is None:
+            raise ImportError("GpuEM requires cupy")
+        shape = (corpus.number_of_documents, corpus.vocabulary_size)
+        # cupyx CSR matrices use int32 indices; convert once rather than on every step
+        self.indptr = cp.asarray(corpus.term_doc_indptr, dtype=cp.int32)
+        self.indices = cp.asarray(corpus.term_doc_indices, dtype=cp.int32)
+        self.data = cp.asarray(corpus.term_doc_data)
+        self.rows = cp.asarray(np.repeat(np.arange(shape[0]), np.diff(corpus.term_doc_indptr)))
+        self.shape = shape
+
+    def em_counts(self, doc_topic, topic_word):
+        # float64 on the device: for float32 inputs P(w | d) >= ~1e-90, so the ratio
+        # c(w, d) / P(w | d) and its products below cannot overflow
+        doc_topic = cp.asarray(doc_topic, dtype=cp.float64)
+        topic_word = cp.asarray(topic_word, dtype=cp.float64)
+        # ratio = c(w, d) / P(w | d) at the nonzero counts only
+        word_prob = cp.einsum('ij,ij->i', doc_topic[self.rows], topic_word.T[self.indices])
+        ratio = cp.where(word_prob > 0, self.data / word_prob, 0)
+        ratio = cupyx.scipy.sparse.csr_matrix((ratio, self.indices, self.indptr), shape=self.shape)
+        topic_word_new = topic_word * (ratio.T @ doc_topic).T
+        document_topic_new = doc_topic * (ratio @ topic_word.T)
+        return cp.asnumpy(document_topic_new.astype(cp.float32)), cp.asnumpy(topic_word_new.astype(cp.float32))
+
+    def close(self):
+        self.indptr = self.indices = self.data = self.rows = None
 
        
 class Corpus(object):
@@ -39,6 +264,22 @@ class Corpus(object):
         self.number_of_documents = 0
         self.vocabulary_size = 0
 
+    @property
+    def term_doc_matrix(self):
+        """ Dense D x V term-doc counts. The EM loop only uses the CSR arrays, so
+        this is built on first access (e.g. by maximization_step) and cached.
+        """
+        if self._term_doc_matrix is None and getattr(self, 'term_doc_indptr', None) is not None:
+            matrix = np.zeros([self.number_of_documents, self.vocabulary_size], dtype=np.float32)
+            rows = np.repeat(np.arange(self.number_of_documents), np.diff(self.term_doc_indptr))
+            matrix[rows, self.term_doc_indices] = self.term_doc_data
+            self._term_doc_matrix = matrix
+        return self._term_doc_matrix
+
+    @term_doc_matrix.setter
+    def term_doc_matrix(self, matrix):
+        self._term_doc_matrix = matrix
+
     def build_corpus(self):
         """
         Read document, fill in self.documents, a list of list of word
@@ -47,8 +288,7 @@ class Corpus(object):
         Update self.number_of_documents
         """
         with open(self.documents_path) as f:
-            lines = f.readlines()       
-        self.documents = [doc.split() for doc in lines]
+            self.documents = [line.split() for line in f]
         self.number_of_documents = len(self.documents)
         
 
@@ -58,10 +298,31 @@ class Corpus(object):
         for example: ["rain", "the", ...]
 
         Update self.vocabulary_size
+
+        The vocabulary is sorted. self.documents is also encoded in one pass: self.token_ids
+        holds the index of each token in self.vocabulary (and self.word2idx), and the
+        tokens of document i are self.token_ids[self.doc_ptr[i]:self.doc_ptr[i+1]]
         """
 
-        self.vocabulary = list(set([voc for elem in self.documents for voc in elem]))
-        self.vocabulary_size = len(self.vocabulary) 
+        # number words in order of first occurrence, then renumber them in sorted order
+        word2idx = {}
+        tokens = array('i')
+        doc_ptr = [0]
+        for document in self.documents:
+            tokens.extend([word2idx.setdefault(word, len(word2idx)) for word in document])
+            doc_ptr.append(len(tokens))
+        self.doc_ptr = np.array(doc_ptr, dtype=np.int64)
+        self.number_of_documents = len(self.documents)
+
+        first_seen = list(word2idx)
+        order = sorted(range(len(first_seen)), key=first_seen.__getitem__)
+        self.vocabulary = [first_seen[i] for i in order]
+        self.vocabulary_size = len(self.vocabulary)
+
+        remap = np.empty(len(order), dtype=np.int32)
+        remap[order] = np.arange(len(order), dtype=np.int32)
+        self.token_ids = remap[np.frombuffer(tokens, dtype=np.intc)]
+        self.word2idx = {word: j for j, word in enumerate(self.vocabulary)}
         
 
     def build_term_doc_matrix(self):
@@ -70,29 +331,40 @@ class Corpus(object):
         and each column represents a vocabulary term.
 
         self.term_doc_matrix[i][j] is the count of term j in document i
+
+        Only the nonzero counts are stored, in CSR form: the columns and counts of
+        document i are term_doc_indices/term_doc_data[term_doc_indptr[i]:term_doc_indptr[i+1]].
+        The dense self.term_doc_matrix is built from them when it is first read.
         """
         num = self.number_of_documents
         size = self.vocabulary_size
-        matrix = np.ones([num, size])
-        for i in range(0, num):
-            for j in range(0, size):
-                matrix[i,j] = self.documents[i].count(self.vocabulary[j])
-        self.term_doc_matrix = matrix  
+        doc_ids = np.repeat(np.arange(num, dtype=np.int64), np.diff(self.doc_ptr))
+        # unique (document, term) keys come back sorted, i.e. already in CSR order
+        keys, counts = np.unique(doc_ids * size + self.token_ids, return_counts=True)
+        rows, cols = np.divmod(keys, size)
 
+        self.term_doc_matrix = None  # built from the CSR arrays on first access
+        self.term_doc_indptr = np.concatenate(([0], np.cumsum(np.bincount(rows, minlength=num))))
+        self.term_doc_indices = cols.astype(np.int32)
+        self.term_doc_data = counts.astype(np.float32)
 
-    def initialize_randomly(self, number_of_topics):
+
+    def initialize_randomly(self, number_of_topics, seed=None):
         """
         Randomly initialize the matrices: document_topic_prob and topic_word_prob
         which hold the probability distributions for P(z | d) and P(w | z): self.document_topic_prob, and self.topic_word_prob
 
         Don't forget to normalize! 
         HINT: you will find numpy's random matrix useful [https://docs.scipy.org/doc/numpy-1.15.0/reference/generated/numpy.random.random.html]
+
+        Pass seed to make the initialization reproducible.
         """
+        rng = np.random.default_rng(seed)
 
-        self.document_topic_prob = np.random.random_sample((self.number_of_documents, number_of_topics))
+        self.document_topic_prob = rng.random((self.number_of_documents, number_of_topics), dtype=np.float32)
         self.document_topic_prob = normalize(self.document_topic_prob)
 
-        self.topic_word_prob = np.random.random_sample((number_of_topics, len(self.vocabulary)))
+        self.topic_word_prob = rng.random((number_of_topics, len(self.vocabulary)), dtype=np.float32)
         self.topic_word_prob = normalize(self.topic_word_prob)
         
 
@@ -109,13 +381,13 @@ class Corpus(object):
         self.topic_word_prob = np.ones((number_of_topics, len(self.vocabulary)))
         self.topic_word_prob = normalize(self.topic_word_prob)
 
-    def initialize(self, number_of_topics, random=False):
+    def initialize(self, number_of_topics, random=False, seed=None):
         """ Call the functions to initialize the matrices document_topic_prob and topic_word_prob
         """
         print("Initializing...")
 
         if random:
-            self.initialize_randomly(number_of_topics)
+            self.initialize_randomly(number_of_topics, seed)
         else:
             self.initialize_uniformly(number_of_topics)
 
@@ -123,54 +395,48 @@ class Corpus(object):
         """ The E-step updates P(z | w, d)
         """
         print("E step:")
-        number = self.number_of_documents
-        size = self.vocabulary_size
-
-        self.topic_prob = np.ones((number, self.topic_word_prob.shape[0], size), dtype=np.float)
-        for i in range(number):
-            for j in range(size):
-                prob = self.document_topic_prob[i,:] * self.topic_word_prob[:,j]
-                
-                if sum(prob) == 0:
-                    exit(0)
-
-                probSum = 0
-                for p in prob:
-                    probSum += p
-
-                prob = prob/probSum
-                self.topic_prob[i,:,j] = prob
+        shape = (self.number_of_documents, self.topic_word_prob.shape[0], self.vocabulary_size)
+        dtype = np.result_type(self.document_topic_prob, self.topic_word_prob)
+        # every element is overwritten, so reuse the previous buffer or leave it uninitialized
+        if self.topic_prob is None or self.topic_prob.shape != shape or self.topic_prob.dtype != dtype:
+            self.topic_prob = np.empty(shape, dtype=dtype)
+        np.einsum('dk,kv->dkv', self.document_topic_prob, self.topic_word_prob, out=self.topic_prob, optimize=True)
+        denom = self.topic_prob.sum(axis=1, keepdims=True)
+        np.maximum(denom, np.finfo(dtype).tiny, out=denom)
+        self.topic_prob *= np.reciprocal(denom, out=denom)
             
 
     def maximization_step(self, number_of_topics):
         """ The M-step updates P(w | z)
         """
         print("M step:")
-        for w in range(self.vocabulary_size):
-            for t in range(number_of_topics):
-                counter = 0
-                for d in range(self.number_of_documents):
-                    term_doc_V = self.term_doc_matrix[d][w]
-                    topic_prob_V = self.topic_prob[d][t][w]
-                    counter = counter + term_doc_V * topic_prob_V
-                self.topic_word_prob[t][w] = counter
-
+        self.topic_word_prob = np.einsum('dw,dtw->tw', self.term_doc_matrix, self.topic_prob, optimize=True)
         self.topic_word_prob = normalize(self.topic_word_prob)
 
         # update P(z | d)
-        for t in range(number_of_topics):
-            for d in range(self.number_of_documents):
-                counter = 0
-                for w in range(self.vocabulary_size):
-                    term_doc_V = self.term_doc_matrix[d][w]
-                    topic_prob_V = self.topic_prob[d][t][w]
-                    counter = counter + term_doc_V * topic_prob_V
-                self.document_topic_prob[d][t] = counter
-
+        self.document_topic_prob = np.einsum('dw,dtw->dt', self.term_doc_matrix, self.topic_prob, optimize=True)
         self.document_topic_prob = normalize(self.document_topic_prob)
         
 
 
+    def expectation_maximization_step(self, number_of_topics, engine=None):
+        """ Fused E- and M-step: accumulates the M-step counts directly from
+        P(z | d) and P(w | z), so the D x K x V topic_prob tensor is never
+        materialized. If engine (a ParallelEM or GpuEM) is given, the counts
+        are computed by it instead.
+        """
+        print("EM step:")
+        if engine is not None:
+            document_topic_new, topic_word_new = engine.em_counts(self.document_topic_prob, self.topic_word_prob)
+        else:
+            document_topic_new, topic_word_new = em_counts(
+                self.term_doc_indptr, self.term_doc_indices, self.term_doc_data,
+                self.document_topic_prob, self.topic_word_prob)
+
+        self.topic_word_prob = normalize(topic_word_new)
+        self.document_topic_prob = normalize(document_topic_new)
+
+
     def calculate_likelihood(self, number_of_topics):
         """ Calculate the current log-likelihood of the model using
         the model's updated probability matrices
@@ -178,49 +444,64 @@ class Corpus(object):
         Append the calculated log-likelihood to self.likelihoods
 
         """
-        currLog = 0
-        for i in range(self.number_of_documents):
-            for j in range(self.vocabulary_size):
-                counter = 0
-                for k in range(number_of_topics):
-                    counter = counter + self.document_topic_prob[i][k] * self.topic_word_prob[k][j]
-                currLog += self.term_doc_matrix[i][j] * math.log(counter,2)    
-                
-        self.likelihoods.append(currLog)        
+        # P(w | d) is only needed where the count is nonzero
+        rows = np.repeat(np.arange(self.number_of_documents), np.diff(self.term_doc_indptr))
+        cols = self.term_doc_indices
+        word_prob = np.einsum('ij,ij->i', self.document_topic_prob[rows], self.topic_word_prob.T[cols])
+        # sum in nats and convert to bits once, instead of a log2 per count
+        currLog = (self.term_doc_data * np.log(word_prob)).sum(dtype=np.float64) / np.log(2)
+
+        self.likelihoods.append(currLog)
         
 
-    def plsa(self, number_of_topics, max_iter, epsilon):
+    def plsa(self, number_of_topics, max_iter, epsilon, seed=None, number_of_workers=1, use_gpu=False,
+             likelihood_interval=1):
 
         """
         Model topics.
+
+        EM stops once the log-likelihood changes by less than epsilon relative to its
+        previous value. It is computed every likelihood_interval iterations (and after
+        the last one), since each evaluation costs about as much as an EM step.
+
+        With number_of_workers > 1 each EM step is split across that many processes;
+        with use_gpu it runs on the GPU (requires cupy).
         """
+        if likelihood_interval < 1:
+            raise ValueError("likelihood_interval must be at least 1, got %r" % (likelihood_interval,))
         print ("EM iteration begins...")
         
         # build term-doc matrix
         self.build_term_doc_matrix()
         
-        # Create the counter arrays.
-        
-        # P(z | d, w)
-        self.topic_prob = np.zeros([self.number_of_documents, number_of_topics, self.vocabulary_size], dtype=np.float)
-
         # P(z | d) P(w | z)
-        self.initialize(number_of_topics, random=True)
+        self.initialize(number_of_topics, random=True, seed=seed)
 
         # Run the EM algorithm
         current_likelihood = 0.0
 
-        for iteration in range(max_iter):
-            print("Iteration #" + str(iteration + 1) + "...")
+        if use_gpu:
+            engine = GpuEM(self)
+        elif number_of_workers > 1:
+            engine = ParallelEM(self, number_of_topics, number_of_workers)
+        else:
+            engine = None
+        try:
+            for iteration in range(max_iter):
+                print("Iteration #" + str(iteration + 1) + "...")
 
-            self.expectation_step()
-            self.maximization_step(number_of_topics)
-            self.calculate_likelihood(number_of_topics)
-            
-            if (iteration >=1 and abs(self.likelihoods[iteration] - self.likelihoods[iteration-1]) < epsilon):
-                break
-            else:
-                continue
+                self.expectation_maximization_step(number_of_topics, engine)
+                if (iteration + 1) % likelihood_interval != 0 and iteration + 1 < max_iter:
+                    continue
+                self.calculate_likelihood(number_of_topics)
+
+                # relative change, so the tolerance does not scale with the corpus size
+                if (len(self.likelihoods) >= 2 and
+                        abs(self.likelihoods[-1] - self.likelihoods[-2]) < epsilon * abs(self.likelihoods[-2])):
+                    break
+        finally:
+            if engine is not None:
+                engine.close()
 
 
 
@@ -234,7 +515,7 @@ def main():
     print("Number of documents:" + str(len(corpus.documents)))
     number_of_topics = 2
     max_iterations = 50
-    epsilon = 0.001
+    epsilon = 1e-6  # relative change in log-likelihood
     corpus.plsa(number_of_topics, max_iterations, epsilon)
 
 
@@ -0,0 +1,222 @@
+import os
+import unittest
+from unittest import mock
+
+import numpy as np
+
+import plsa
+
+TEST_DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'test.txt')
+
+
+def load_corpus(number_of_topics=3, seed=0):
+    corpus = plsa.Corpus(TEST_DATA)
+    corpus.build_corpus()
+    corpus.build_vocabulary()
+    corpus.build_term_doc_matrix()
+    corpus.initialize_randomly(number_of_topics, seed=seed)
+    return corpus
+
+
+def serial_em_counts(corpus):
+    return plsa.em_counts(corpus.term_doc_indptr, corpus.term_doc_indices, corpus.term_doc_data,
+                          corpus.document_topic_prob, corpus.topic_word_prob)
+
+
+def reference_em_step(corpus):
+    """ One unfused E- and M-step in float64, returning the normalized (P(z | d), P(w | z)) """
+    reference = plsa.Corpus(corpus.documents_path)
+    reference.number_of_documents = corpus.number_of_documents
+    reference.vocabulary_size = corpus.vocabulary_size
+    reference.term_doc_matrix = np.zeros((corpus.number_of_documents, corpus.vocabulary_size))
+    rows = np.repeat(np.arange(corpus.number_of_documents), np.diff(corpus.term_doc_indptr))
+    reference.term_doc_matrix[rows, corpus.term_doc_indices] = corpus.term_doc_data
+    reference.document_topic_prob = corpus.document_topic_prob.astype(np.float64)
+    reference.topic_word_prob = corpus.topic_word_prob.astype(np.float64)
+    reference.expectation_step()
+    reference.maximization_step(corpus.topic_word_prob.shape[0])
+    return reference.document_topic_prob, reference.topic_word_prob
+
+
+def csr_corpus(term_doc_matrix, doc_topic, topic_word):
+    corpus = plsa.Corpus(None)
+    term_doc_matrix = np.asarray(term_doc_matrix, dtype=np.float32)
+    corpus.number_of_documents, corpus.vocabulary_size = term_doc_matrix.shape
+    rows, cols = np.nonzero(term_doc_matrix)
+    corpus.term_doc_indptr = np.concatenate(([0], np.cumsum(np.bincount(rows, minlength=len(term_doc_matrix)))))
+    corpus.term_doc_indices = cols.astype(np.int32)
+    corpus.term_doc_data = term_doc_matrix[rows, cols]
+    corpus.document_topic_prob = np.asarray(doc_topic, dtype=np.float32)
+    corpus.topic_word_prob = np.asarray(topic_word, dtype=np.float32)
+    return corpus
+
+
+class NormalizeTest(unittest.TestCase):
+
+    def test_rows_sum_to_one_and_zero_rows_stay_zero(self):
+        matrix = np.array([[1, 3], [0, 0], [2, 2]], dtype=np.float32)
+        result = plsa.normalize(matrix)
+        self.assertIs(result, matrix)
+        np.testing.assert_allclose(result, [[.25, .75], [0, 0], [.5, .5]])
+
+    def test_integer_input(self):
+        np.testing.assert_allclose(plsa.normalize(np.ones((2, 3), dtype=int)), np.full((2, 3), 1 / 3))
+
+
+class VocabularyTest(unittest.TestCase):
+
+    def test_documents_filled_by_caller(self):
+        corpus = plsa.Corpus(None)
+        corpus.documents = [["b", "a", "b"], ["c", "a"]]
+        corpus.build_vocabulary()
+        corpus.build_term_doc_matrix()
+        self.assertEqual(corpus.vocabulary, ["a", "b", "c"])
+        np.testing.assert_array_equal(corpus.term_doc_matrix, [[1, 2, 0], [1, 0, 1]])
+
+    def test_documents_changed_after_build_corpus(self):
+        corpus = plsa.Corpus(TEST_DATA)
+        corpus.build_corpus()
+        corpus.documents = [[w for w in d if w != 'mount'] for d in corpus.documents]
+        corpus.build_vocabulary()
+        corpus.build_term_doc_matrix()
+        self.assertNotIn('mount', corpus.vocabulary)
+        self.assertEqual(corpus.term_doc_data.sum(), sum(len(d) for d in corpus.documents))
+
+    def test_token_ids_follow_sorted_vocabulary(self):
+        corpus = plsa.Corpus(TEST_DATA)
+        corpus.build_corpus()
+        corpus.build_vocabulary()
+        self.assertEqual(corpus.vocabulary, sorted(set(w for d in corpus.documents for w in d)))
+        for i in (0, 1, len(corpus.documents) - 1):
+            ids = corpus.token_ids[corpus.doc_ptr[i]:corpus.doc_ptr[i + 1]]
+            self.assertEqual([corpus.vocabulary[j] for j in ids], corpus.documents[i])
+
+
+class TermDocMatrixTest(unittest.TestCase):
+
+    def test_plsa_keeps_only_csr_counts(self):
+        corpus = plsa.Corpus(TEST_DATA)
+        corpus.build_corpus()
+        corpus.build_vocabulary()
+        with mock.patch('sys.stdout'):
+            corpus.plsa(2, 2, 1e-6, seed=0)
+        self.assertIsNone(corpus._term_doc_matrix)
+
+        matrix = corpus.term_doc_matrix
+        self.assertEqual(matrix.shape, (corpus.number_of_documents, corpus.vocabulary_size))
+        self.assertEqual(matrix.sum(), len(corpus.token_ids))
+        j = corpus.word2idx[corpus.documents[0][0]]
+        self.assertEqual(matrix[0, j], corpus.documents[0].count(corpus.documents[0][0]))
+
+
+class EmCountsTest(unittest.TestCase):
+
+    def assert_matches_reference(self, corpus):
+        with mock.patch('sys.stdout'):
+            expected = reference_em_step(corpus)
+        actual = serial_em_counts(corpus)
+        for a, e in zip(actual, expected):
+            self.assertTrue(np.isfinite(a).all())
+            np.testing.assert_allclose(plsa.normalize(a.copy()), e, rtol=1e-4, atol=1e-6)
+
+    def test_numpy_fallback_matches_unfused_steps(self):
+        with mock.patch.object(plsa, 'njit', None):
+            self.assert_matches_reference(load_corpus())
+
+    @unittest.skipIf(plsa.njit is None, "numba is not installed")
+    def test_numba_matches_unfused_steps(self):
+        self.assert_matches_reference(load_corpus())
+
+    @unittest.skipIf(plsa.njit is None, "numba is not installed")
+    def test_numba_subnormal_word_prob(self):
+        corpus = csr_corpus([[1, 3]], [[1, 1e-41]], [[0, 1], [.5, .5]])
+        document_topic_new, topic_word_new = serial_em_counts(corpus)
+        np.testing.assert_allclose(document_topic_new, [[3, 1]], rtol=1e-5)
+        self.assertTrue(np.isfinite(topic_word_new).all())
+
+    def test_numpy_fallback_subnormal_word_prob(self):
+        # P(w | d) for the first word is subnormal and P(w | z) has exact zeros
+        corpus = csr_corpus([[1, 3]], [[1, 1e-41]], [[0, 1], [.5, .5]])
+        with mock.patch.object(plsa, 'njit', None):
+            document_topic_new, topic_word_new = serial_em_counts(corpus)
+        np.testing.assert_allclose(document_topic_new, [[3, 1]], rtol=1e-5)
+        self.assertTrue(np.isfinite(topic_word_new).all())
+
+
+class PlsaTest(unittest.TestCase):
+
+    def run_plsa(self, max_iter, epsilon, **kwargs):
+        corpus = plsa.Corpus(TEST_DATA)
+        corpus.build_corpus()
+        corpus.build_vocabulary()
+        with mock.patch('sys.stdout'):
+            corpus.plsa(2, max_iter, epsilon, seed=0, **kwargs)
+        return corpus
+
+    def test_likelihood_increases(self):
+        likelihoods = self.run_plsa(10, 0).likelihoods
+        self.assertEqual(len(likelihoods), 10)
+        # EM never decreases the likelihood, up to float32 rounding
+        self.assertTrue(np.all(np.diff(likelihoods) >= -1e-6 * np.abs(likelihoods[1:])))
+
+    def test_relative_convergence(self):
+        likelihoods = self.run_plsa(50, 1e-3).likelihoods
+        self.assertLess(len(likelihoods), 50)
+        self.assertLess(abs(likelihoods[-1] - likelihoods[-2]), 1e-3 * abs(likelihoods[-2]))
+        for previous, current in zip(likelihoods[:-2], likelihoods[1:-1]):
+            self.assertGreaterEqual(abs(current - previous), 1e-3 * abs(previous))
+
+    def test_likelihood_interval(self):
+        # evaluated after iterations 3, 6 and the last one, 7
+        self.assertEqual(len(self.run_plsa(7, 0, likelihood_interval=3).likelihoods), 3)
+
+    def test_likelihood_interval_must_be_positive(self):
+        with self.assertRaises(ValueError):
+            self.run_plsa(5, 0, likelihood_interval=0)
+
+
+class ParallelEMTest(unittest.TestCase):
+
+    def test_matches_em_counts_after_serial_em(self):
+        corpus = load_corpus()
+        # run the in-process sweep first, so any thread pool it starts exists before the workers
+        expected = serial_em_counts(corpus)
+        engine = plsa.ParallelEM(corpus, 3, 2)
+        try:
+            actual = engine.em_counts(corpus.document_topic_prob, corpus.topic_word_prob)
+        finally:
+            engine.close()
+        for a, e in zip(actual, expected):
+            np.testing.assert_allclose(a, e, rtol=1e-4, atol=1e-6 * e.max())
+
+
+class GpuEMTest(unittest.TestCase):
+
+    @unittest.skipIf(plsa.cp is None, "cupy is not installed")
+    def test_matches_em_counts(self):
+        corpus = load_corpus()
+        corpus.document_topic_prob[0] = 0  # P(w | d) = 0 must not produce inf or nan
+
+        expected = serial_em_counts(corpus)
+        engine = plsa.GpuEM(corpus)
+        try:
+            actual = engine.em_counts(corpus.document_topic_prob, corpus.topic_word_prob)
+        finally:
+            engine.close()
+        for a, e in zip(actual, expected):
+            np.testing.assert_allclose(a, e, rtol=1e-4, atol=1e-6 * e.max())
+
+    @unittest.skipIf(plsa.cp is None, "cupy is not installed")
+    def test_subnormal_word_prob(self):
+        corpus = csr_corpus([[1, 3]], [[1, 1e-41]], [[0, 1], [.5, .5]])
+        engine = plsa.GpuEM(corpus)
+        try:
+            document_topic_new, topic_word_new = engine.em_counts(corpus.document_topic_prob, corpus.topic_word_prob)
+        finally:
+            engine.close()
+        np.testing.assert_allclose(document_topic_new, [[3, 1]], rtol=1e-5)
+        self.assertTrue(np.isfinite(topic_word_new).all())
+
+
+if __name__ == '__main__':
+    unittest.main()